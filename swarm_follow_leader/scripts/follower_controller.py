@@ -11,7 +11,12 @@ import numpy as np
 from avoidance_engine import avoidance_engine
 from formation_engine import formation_engine
 from fusion_engine import fusion_engine
+from fuzzy_inference import CompiledEngine
+import logging
 import sys
+import threading
+
+INF = float('inf') # Distance used when the lidar detects nothing
 
 class Follower:
     """ ROS node for follower robot controller """
@@ -19,16 +24,40 @@ class Follower:
         rospy.init_node(f'{robot_ns}_follower')
 
         # Setup publishers and subscribers
-        self.vel_pub = rospy.Publisher(f'/{robot_ns}/cmd_vel', Twist, queue_size=10)
-        rospy.Subscriber(f'/{robot_ns}/scan', LaserScan, self.process_scan)
-        rospy.Subscriber(f'/{robot_ns}/angle_to_leader', Float32, self.process_leader_angle)
+        # Only the newest message matters, so drop stale ones instead of queueing them
+        self.vel_pub = rospy.Publisher(f'/{robot_ns}/cmd_vel', Twist, queue_size=1, tcp_nodelay=True)
+        rospy.Subscriber(f'/{robot_ns}/scan', LaserScan, self.process_scan,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
+        rospy.Subscriber(f'/{robot_ns}/angle_to_leader', Float32, self.process_leader_angle,
+                         queue_size=1, tcp_nodelay=True)
+
+        # Scan, leader angle and timer callbacks run on separate threads and share the state below
+        self._lock = threading.Lock()
 
         # Define instance variables
         self.all_lidar_data = None
         self.laser_distances = None
+        self._min_laser = None
         self.offset_angle = None
+        self._offset_window = None
+        self._abs_distance = None
         self.all_detected = None
         self.desired_distance = .75 # Desired distance to keep between leader and follower
+        # Seconds without a new scan before the robot is stopped, three periods of the 5 Hz lidar
+        self.scan_timeout = rospy.get_param('~scan_timeout', .6)
+        self._last_scan_time = None # When the latest scan was processed
+        self._debug = rospy.get_param('~debug', False) # Collect extra lidar info for debugging
+        self._twist = Twist() # Reused velocity command, publish() serializes it immediately
+        self._logger = logging.getLogger('rosout') # Logger behind rospy.logdebug()
+        self._lidar_buf = np.empty(360, dtype=np.float32) # Reused storage for the latest lidar scan
+        self._last_inputs = None # Controller inputs from the last inference pass
+        self._last_outputs = None # Controller outputs from the last inference pass
+
+        # Neighboring lidar indices (+/- 7) around the left, right, and front angles
+        self._scan_idx = np.stack([(theta + np.arange(-7, 8)) % 360 for theta in (90, 270, 0)])
+
+        # Compile the fuzzy logic controllers into a single engine so they run in one inference pass
+        self.flc = CompiledEngine(formation_engine, avoidance_engine, fusion_engine)
 
         # Setup Fuzzy Logic Controller Inputs
         self.angle = formation_engine.input_variable('Angle')
@@ -47,129 +76,181 @@ class Follower:
         self.formation_weight = fusion_engine.output_variable('Formation_Weight')
         self.collision_weight = fusion_engine.output_variable('Collision_Weight')
 
+        # Positions of the outputs above in the values returned by self.flc.process()
+        self._output_idx = [self.flc.output_index(var) for var in
+                            (self.vel_formation, self.rot_formation, self.vel_avoidance,
+                             self.rot_avoidance, self.formation_weight, self.collision_weight)]
+
     def process_scan(self, msg):
         """ Process lidar scan data and extracts distance measurements from left, right and front """
-        self.all_lidar_data = msg.ranges[:360]
+        with self._lock:
+            # Convert the ranges once and copy a view of the first 360 degrees into the preallocated buffer
+            np.copyto(self._lidar_buf, np.asarray(msg.ranges, dtype=np.float32)[:360])
+
+            # Average the left, right, and front lidar windows in a single pass
+            vals = self._lidar_buf[self._scan_idx]
+            mask = np.isfinite(vals)
+            counts = mask.sum(1)
+            sums = np.where(mask, vals, 0).sum(1)
+            distances = np.where(counts > 0, sums / np.maximum(counts, 1), INF)
+            self.laser_distances = distances.tolist()
+
+            # Closest of the three averaged distances, used as an input to fuzzy_inference()
+            finite = np.isfinite(distances)
+            self._min_laser = float(distances[finite].min()) if finite.any() else INF
+
+            # For debugging purposes, collects all angles that the lidar dectects distances
+            if self._debug:
+                self.all_detected = np.flatnonzero(np.isfinite(self._lidar_buf))
+
+            # Tells _tick() that a newly processed scan is available
+            self._last_scan_time = rospy.get_time()
+            self.all_lidar_data = self._lidar_buf
 
-        # left, right, and front lidar angles
-        angles = [90, 270, 0] 
-        self.laser_distances = [self.get_average_distance(theta, 7) for theta in angles]
-
-        # For debugging purposes, collects all angles that the lidar dectects distances
-        self.all_detected = [i for i, angle in enumerate(msg.ranges) if not (angle == float('inf'))]
-        
     def process_leader_angle(self, msg):
         """ Process offset from leader angle determined from the AR tags """
-        self.offset_angle = msg.data
+        with self._lock:
+            # Neighboring lidar indices (+/- 3) in the direction of the leader
+            offset_idx = (360 - int(msg.data)) % 360
+            self._offset_window = (offset_idx + np.arange(-3, 4)) % 360
 
-    def get_average_distance(self, angle, n, distance=None):
-        """ 
-        Gets the average of the neighboring lidar distances for a more robust distance measurement 
-        
-        Instead of relying on a single lidar distance measurement, the average of the +/- n nearby 
-        angles are calculated for an average distance. If a lidar distance is inf it is not included
-        in the average calculation. 
+            self.offset_angle = msg.data
+
+    def get_window_distance(self, idx):
+        """
+        Gets the average of the neighboring lidar distances for a more robust distance measurement
+
+        Instead of relying on a single lidar distance measurement, the average of a window of nearby
+        angles is calculated. If a lidar distance is inf it is not included in the average calculation.
 
         Args:
-            angle: the original lidar angle
-            n: number of +/- surrounding lidar angles to perform average calculation
-            distance: [optional] array of lidar distances
+            idx: array of lidar angles (already wrapped to 0-359) to average over
         Returns:
-            average: the average of the angle and +/- neighboring angles
+            average: the average of the finite distances, or inf if none of them are finite
         """
-        if self.all_lidar_data is None and distance is None:
+        if self.all_lidar_data is None:
             return None
-            
-        avg, count = 0, 0
-        for i in range(-n, n+1):
-            neighbor = self.all_lidar_data[(angle + i) % 360]
-            if neighbor != float('inf'):
-                avg += neighbor
-                count += 1
-        
-        return avg / count if count else float('inf')
+
+        vals = self.all_lidar_data[idx]
+        mask = np.isfinite(vals)
+        count = int(mask.sum())
+
+        return float(vals[mask].sum()) / count if count else INF
 
     def fuzzy_formation(self):
-        """ Fuzzy logic controller that determines the robot commands to keep in formation """
+        """
+        Feeds the fuzzy logic controller that determines the robot commands to keep in formation
+
+        Returns:
+            ready: whether there was leader angle and lidar data to feed to the controller
+        """
         if self.offset_angle is None or self.all_lidar_data is None:
-            return None, None
+            return False
 
         # Feed offset angle and offset distance as input to the fuzzy controller
         self.angle.value = self.offset_angle
-        actual_offset_distance = self.get_average_distance((360-int(self.offset_angle)), 3)
-
-        if actual_offset_distance is None:
-            return None, None
+        actual_offset_distance = self.get_window_distance(self._offset_window)
 
+        # Negative when the leader is farther than desired, which the rule base maps to faster velocities
         self.distance.value = self.desired_distance - actual_offset_distance
+        self._abs_distance = abs(self.distance.value) # Position measure fed to fuzzy_inference()
 
-        # Perform fuzzy inference
-        formation_engine.process()
-
-        return self.vel_formation.value, self.rot_formation.value
+        return True
 
     def fuzzy_collision_avoidance(self):
-        """ Fuzzy logic controller that determines the robot commands to avoid obstacles and internal collision """
+        """
+        Feeds the fuzzy logic controller that determines the robot commands to avoid obstacles and internal collision
+
+        Returns:
+            ready: whether there was laser distance data to feed to the controller
+        """
         # Skip if no laser distance data
         if self.laser_distances is None:
-            return None, None
+            return False
+
+        # Feed lidar scan distances as input to the fuzzy controller (already inf when nothing was detected)
+        self.left_laser.value, self.right_laser.value, self.front_laser.value = self.laser_distances
+
+        return True
+
+    def fuzzy_inference(self):
+        """
+        Feeds the fusion controller and runs formation, collision avoidance and fusion in one inference pass
+
+        Must be called after fuzzy_formation() and fuzzy_collision_avoidance() have fed their inputs.
+        If the inputs haven't changed since the last call, the previous outputs are reused.
+
+        Returns:
+            v1: velocity output of the formation controller
+            r1: angular_velocity output of the formation controller
+            v2: velocity output of the collision avoidance controller
+            r2: angular_velocity output of the collision avoidance controller
+            f_W: formation weight output of the fusion controller
+            c_W: collision weight output of the fusion controller
+        """
+        # The fusion inputs are derived from these, so they don't need to be compared separately
+        inputs = np.array([self.angle.value, self.distance.value, *self.laser_distances])
+        if self._last_inputs is not None and np.allclose(inputs, self._last_inputs, rtol=0, atol=1e-3):
+            return self._last_outputs
 
-        # Feed lidar scan distances as input to the fuzzy controller
-        self.left_laser.value = self.laser_distances[0] if self.laser_distances[0] else float('inf')
-        self.right_laser.value = self.laser_distances[1] if self.laser_distances[0] else float('inf')
-        self.front_laser.value = self.laser_distances[2] if self.laser_distances[0] else float('inf')
+        self.position_measure.value = self._abs_distance
+        self.min_laser.value = self._min_laser
 
         # Perform fuzzy inference
-        avoidance_engine.process()
+        values = self.flc.process()
+
+        self._last_inputs = inputs
+        self._last_outputs = tuple(values[i] for i in self._output_idx)
 
-        return self.vel_avoidance.value, self.rot_avoidance.value
+        return self._last_outputs
 
-    def fuzzy_fusion(self, v1, r1, v2, r2):
+    def fuzzy_fusion(self, v1, r1, v2, r2, f_W, c_W):
         """
-        Fuzzy logic controller that combines formation and collision avoidance
+        Combines formation and collision avoidance using the weights from the fusion controller
         
         Args:
-            v1: velocity output from fuzzy_formation()
-            r1: angular_velocity output from fuzzy_formation()
-            v2: velocity output from fuzzy_collision_avoidance()
-            r2: angular_velocity output from fuzzy_collision_avoidance()
+            v1: velocity output of the formation controller
+            r1: angular_velocity output of the formation controller
+            v2: velocity output of the collision avoidance controller
+            r2: angular_velocity output of the collision avoidance controller
+            f_W: formation weight output of the fusion controller
+            c_W: collision weight output of the fusion controller
         Returns:
             v_final: final velocity calculated from a weighted sum of formation and collision avoidance
             r_final: final angular velocity calculated from a weighted sum of formation and collision avoidance
         """
-        self.position_measure.value = abs(self.distance.value)
-        self.min_laser.value = min(self.left_laser.value, self.right_laser.value, self.front_laser.value)
-
-        # Perform fuzzy inference
-        fusion_engine.process()
-
-        # Get weights
-        f_W = self.formation_weight.value
-        c_W = self.collision_weight.value
-
-        # Perform weighted sum calculation
-        v_final = v1 * f_W + v2 * c_W
-        r_final = r1 * f_W + r2 * c_W
+        # Perform weighted sum calculation, one row of (velocity, angular_velocity) per behavior
+        vr = np.array([[v1, r1], [v2, r2]])
+        w = np.array([f_W, c_W])
+        v_final, r_final = (w @ vr).tolist()
 
         return v_final, r_final
 
-    def run(self):
-        r = rospy.Rate(5)
-        while not rospy.is_shutdown():
-            # Call fuzzy controllers
-            v1, r1 = self.fuzzy_formation()
-            v2, r2 = self.fuzzy_collision_avoidance()
-
-            m = Twist()
-
-            # Merge fuzzy controller outputs
-            if v1 is not None and v2 is not None:
-                v_final, r_final = self.fuzzy_fusion(v1, r1, v2, r2)
-                
-                print('Formation vel:', round(v1, 4), 'Formation rot:', round(r1, 4), \
-                      'Collision vel:', round(v2, 4), 'Collision rot', round(r2, 4), \
-                      'Fusion vel:', round(v_final, 4), 'Fusion rot:', round(r_final, 4))
-                      
+    def _tick(self, event):
+        """ Timer callback that runs the fuzzy controllers once a new lidar scan has arrived """
+        with self._lock:
+            m = self._twist
+
+            # Wait for fresh lidar data instead of reacting to the same scan again
+            if self.all_lidar_data is None:
+                # Stop movement if the lidar has gone quiet for several scan periods
+                if self._last_scan_time is None or rospy.get_time() - self._last_scan_time > self.scan_timeout:
+                    m.linear.x = 0
+                    m.angular.z = 0
+                    self.vel_pub.publish(m)
+                return
+
+            # Feed and call fuzzy controllers, then merge their outputs
+            if self.fuzzy_formation() and self.fuzzy_collision_avoidance():
+                v1, r1, v2, r2, f_W, c_W = self.fuzzy_inference()
+                v_final, r_final = self.fuzzy_fusion(v1, r1, v2, r2, f_W, c_W)
+
+                # Only format the message when rospy debug logging is enabled for this node
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    rospy.logdebug_throttle(1.0, f'Formation vel: {v1:.4f} Formation rot: {r1:.4f} '
+                                                 f'Collision vel: {v2:.4f} Collision rot: {r2:.4f} '
+                                                 f'Fusion vel: {v_final:.4f} Fusion rot: {r_final:.4f}')
+
                 # m.linear.x = 0
                 m.linear.x = v_final
                 m.angular.z =  r_final
@@ -179,13 +260,17 @@ class Follower:
                 self.laser_distances = None
                 self.offset_angle = None
             else:
-                # Stop movement if there is no valid output from fuzzy controllers
+                # Stop movement if there is no valid output from fuzzy controllers, once per scan
                 m.linear.x = 0
                 m.angular.z =  0
+                self.all_lidar_data = None
 
             self.vel_pub.publish(m)
 
-            r.sleep()
+    def run(self):
+        # Check for new data at up to 20 Hz so commands go out as soon as a scan is processed
+        rospy.Timer(rospy.Duration(0.05), self._tick)
+        rospy.spin()
 
         print("Shutting down")
 
@@ -0,0 +1,189 @@
+""" Precompiled Mamdani inference for the fuzzylite engines used by the follower """
+
+import fuzzylite as fl
+import numpy as np
+
+
+class CompiledEngine:
+    """
+    Vectorized replacement for fl.Engine.process() on one or more Mamdani engines
+
+    The fuzzylite engines stay the single source of truth for the variables, terms and rules.
+    On construction the rules are flattened into index tables and every output term is sampled
+    once over the centroid grid, so each call to process() only evaluates the input memberships
+    and then does the rule activation, aggregation and centroid defuzzification as NumPy array
+    operations. Passing several independent engines batches all of their rule bases into a
+    single process() call. Supports the subset of fuzzylite the engines in this package use:
+    rules made of "and"-joined antecedents without hedges, General activation, Minimum
+    conjunction and implication, Maximum aggregation and a Centroid defuzzifier. Anything else
+    raises a ValueError on construction rather than silently giving results that differ from
+    fuzzylite. Disabled variables, default values and lock_previous behave as in fuzzylite.
+    """
+    def __init__(self, *engines):
+        self.inputs, self.outputs, rules = [], [], []
+        for engine in engines:
+            for block in engine.rule_blocks:
+                if not block.enabled:
+                    continue
+                if not isinstance(block.activation, fl.General):
+                    raise ValueError(f'Rule block {block.name} of {engine.name} must use General activation')
+                if not isinstance(block.conjunction, fl.Minimum) or not isinstance(block.implication, fl.Minimum):
+                    raise ValueError(f'Rule block {block.name} of {engine.name} must use Minimum conjunction and implication')
+                rules += [rule for rule in block.rules if rule.enabled]
+            for var in engine.output_variables:
+                if not isinstance(var.aggregation, fl.Maximum) or not isinstance(var.defuzzifier, fl.Centroid):
+                    raise ValueError(f'Output {var.name} of {engine.name} must use Maximum aggregation and Centroid')
+            self.inputs += engine.input_variables
+            self.outputs += engine.output_variables
+
+        # antecedents[r, i] is the term index of input i in rule r (-1 if the rule doesn't use it)
+        self.antecedents = np.full((len(rules), len(self.inputs)), -1, dtype=np.intp)
+        # consequents[r, o] is the term index of output o in rule r (-1 if the rule doesn't set it)
+        self.consequents = np.full((len(rules), len(self.outputs)), -1, dtype=np.intp)
+        self.weights = np.array([rule.weight for rule in rules], dtype=np.float64)
+
+        # Use the propositions fuzzylite already loaded, which point at the variable and term objects
+        for r, rule in enumerate(rules):
+            for proposition in self._propositions(rule.antecedent.expression):
+                i = self._index(self.inputs, proposition.variable)
+                self.antecedents[r, i] = self._index(self.inputs[i].terms, proposition.term)
+            for proposition in rule.consequent.conclusions:
+                self._check_proposition(proposition)
+                o = self._index(self.outputs, proposition.variable)
+                self.consequents[r, o] = self._index(self.outputs[o].terms, proposition.term)
+
+        # Sample each output term once at the same points fuzzylite's Centroid integrates over
+        self.grids, self.memberships = [], []
+        for var in self.outputs:
+            resolution = var.defuzzifier.resolution
+            dx = (var.maximum - var.minimum) / resolution
+            x = var.minimum + (np.arange(resolution) + 0.5) * dx
+            self.grids.append(x)
+            self.memberships.append(np.array([[term.membership(xi) for xi in x] for term in var.terms]))
+
+    def output_index(self, variable):
+        """
+        Gets the position of an output variable in the values returned by process()
+
+        Args:
+            variable: one of the output variables of the compiled engines
+        Returns:
+            index: position of the variable, matched by identity since output names repeat across engines
+        """
+        return self._index(self.outputs, variable)
+
+    @staticmethod
+    def _index(items, item):
+        """ Position of item in items by identity, since the same names repeat across engines """
+        for i, candidate in enumerate(items):
+            if candidate is item:
+                return i
+        raise ValueError(f'{getattr(item, "name", item)} does not belong to the compiled engines')
+
+    @staticmethod
+    def _check_proposition(proposition):
+        if proposition.hedges:
+            raise ValueError(f'Hedges are not supported: {proposition}')
+
+    @classmethod
+    def _propositions(cls, expression):
+        """ Flattens an antecedent expression tree of "and" operators into its propositions """
+        if isinstance(expression, fl.Proposition):
+            cls._check_proposition(expression)
+            return [expression]
+        if isinstance(expression, fl.Operator) and expression.name == fl.Rule.AND:
+            return cls._propositions(expression.left) + cls._propositions(expression.right)
+        raise ValueError(f'Only "and"-joined antecedents are supported: {expression}')
+
+    def process(self):
+        """
+        Runs inference on the current input variable values and stores the results in the output variables
+
+        Returns:
+            values: tuple of the defuzzified output values, in output variable order of each engine
+        """
+        # Membership degree of every rule antecedent, with unused inputs treated as fully satisfied
+        degrees = np.ones(self.antecedents.shape)
+        for i, var in enumerate(self.inputs):
+            # Like fuzzylite, propositions on a disabled input have no activation
+            if var.enabled:
+                mu = np.array([term.membership(var.value) for term in var.terms])
+            else:
+                mu = np.zeros(len(var.terms))
+            used = self.antecedents[:, i] >= 0
+            degrees[used, i] = mu[self.antecedents[used, i]]
+        activation = self.weights * degrees.min(axis=1)
+
+        # fuzzylite only triggers rules whose activation is above its tolerance
+        triggered = activation >= fl.lib.abs_tolerance
+
+        values = []
+        for o, var in enumerate(self.outputs):
+            # Disabled outputs keep their value, as in OutputVariable.defuzzify()
+            if not var.enabled:
+                values.append(var.value)
+                continue
+            if np.isfinite(var.value):
+                var.previous_value = var.value
+
+            fired = (self.consequents[:, o] >= 0) & triggered
+            value = None
+            if fired.any():
+                implied = np.minimum(activation[fired, None], self.memberships[o][self.consequents[fired, o]])
+                aggregated = implied.max(axis=0)
+                area = aggregated.sum()
+                if area > 0:
+                    value = float(aggregated @ self.grids[o] / area)
+
+            # Nothing fired, so fall back to the previous or default value like fuzzylite
+            if value is None:
+                if var.lock_previous and not np.isnan(var.previous_value):
+                    value = var.previous_value
+                else:
+                    value = var.default_value
+
+            # The value setter applies lock_range
+            var.value = value
+            values.append(var.value)
+
+        return tuple(values)
+
+
+if __name__ == "__main__":
+    # Checking the compiled engines against fuzzylite on a grid of inputs
+    import itertools
+    from avoidance_engine import avoidance_engine
+    from formation_engine import formation_engine
+    from fusion_engine import fusion_engine
+
+    def check(engine, points, label):
+        compiled = CompiledEngine(engine)
+        grids = [np.linspace(var.minimum, var.maximum, points) for var in engine.input_variables]
+        worst, mismatches, count = 0.0, 0, 0
+        for values in itertools.product(*grids):
+            for var, value in zip(engine.input_variables, values):
+                var.value = value
+            engine.process()
+            expected = np.array([var.value for var in engine.output_variables])
+            # Start from the same previous values fuzzylite had so lock_previous is compared fairly
+            for var in engine.output_variables:
+                var.value = var.previous_value
+            actual = np.array(compiled.process())
+            close = np.isclose(actual, expected, atol=1e-6, equal_nan=True)
+            mismatches += int(not close.all())
+            finite = np.isfinite(expected) & np.isfinite(actual)
+            worst = max(worst, float(np.abs(actual - expected)[finite].max(initial=0.0)))
+            count += 1
+
+        print(f'{engine.name} ({label}): {mismatches}/{count} mismatched input sets, '
+              f'max abs difference {worst:.2e}')
+
+    for engine in (formation_engine, avoidance_engine, fusion_engine):
+        check(engine, 21, 'as defined')
+
+        # Fallback values and a disabled input, on a coarser grid
+        for var in engine.output_variables:
+            var.default_value, var.lock_previous = 0.0, True
+        check(engine, 11, 'default and previous values')
+        engine.input_variables[0].enabled = False
+        check(engine, 11, 'first input disabled')